@@ -13,54 +13,140 @@
 # limitations under the License.
 
 from collections.abc import Sequence
+import functools
 import io
 import re
-import textwrap
 from typing import IO
 import unittest
 
 from absl.testing import absltest
+from absl.testing import parameterized
 import jax
 from jax import config
 from jax.experimental import pjit
 from jax._src import debugger
 from jax._src import test_util as jtu
+from jax._src import xla_bridge
 import jax.numpy as jnp
 import numpy as np
 
 config.parse_flags_with_absl()
 
-def make_fake_stdin_stdout(commands: Sequence[str]) -> tuple[IO[str], io.StringIO]:
-  fake_stdin = io.StringIO()
-  fake_stdin.truncate(0)
-  for command in commands:
-    fake_stdin.write(command + "\n")
-  fake_stdin.seek(0)
-  return fake_stdin, io.StringIO()
+class _ListIO:
+  """Capture-only stdout; the debugger only calls `write` and `flush`."""
 
+  def __init__(self):
+    self._chunks: list[str] = []
+
+  def write(self, s: str) -> int:
+    self._chunks.append(s)
+    return len(s)
+
+  def flush(self) -> None:
+    pass
+
+  def getvalue(self) -> str:
+    return "".join(self._chunks)
+
+def make_fake_stdin_stdout(commands: Sequence[str]) -> tuple[IO[str], _ListIO]:
+  fake_stdin = io.StringIO("".join(command + "\n" for command in commands))
+  return fake_stdin, _ListIO()
+
+# Expected-output literals are always written at the 4-space indentation of a
+# test method body.
+_LEADING_INDENT = re.compile(r"(?m)^    ")
+
+@functools.cache
 def _format_multiline(text):
-  return textwrap.dedent(text).lstrip()
+  return _LEADING_INDENT.sub("", text).lstrip()
+
+# `debugger.breakpoint` captures its streams when the function is traced, so
+# the module-level jitted functions below are handed `_SlotIO` proxies. Tests
+# swap the real fake streams in via `_IO_SLOT` and reuse the compiled function.
+_IO_SLOT: dict[str, IO[str] | _ListIO] = {}
+
+class _SlotIO:
+  """Forwards all stream operations to the stream stored in `_IO_SLOT`."""
+
+  def __init__(self, name: str):
+    self._name = name
+
+  def __getattr__(self, attr):
+    return getattr(_IO_SLOT[self._name], attr)
+
+_stdin = _SlotIO("stdin")
+_stdout = _SlotIO("stdout")
+
+def install_fake_stdin_stdout(
+    commands: Sequence[str]) -> tuple[IO[str], _ListIO]:
+  stdin, stdout = make_fake_stdin_stdout(commands)
+  _IO_SLOT["stdin"], _IO_SLOT["stdout"] = stdin, stdout
+  return stdin, stdout
+
+@jax.jit
+def _sin_with_breakpoint(x):
+  y = jnp.sin(x)
+  debugger.breakpoint(stdin=_stdin, stdout=_stdout, backend="cli")
+  return y
+
+@jax.pmap
+def _pmap_sin_exp_with_breakpoint(x):
+  y = jnp.sin(x)
+  debugger.breakpoint(stdin=_stdin, stdout=_stdout, backend="cli")
+  return jnp.exp(y)
+
+# The `l` listing at the breakpoint in `_sin_with_breakpoint`.
+_SIN_WITH_BREAKPOINT_CONTEXT_RE = re.compile(_format_multiline(r"""
+    Entering jdb:
+    \(jdb\) > .*debugger_test\.py\([0-9]+\)
+        @jax\.jit
+        def _sin_with_breakpoint\(x\):
+          y = jnp\.sin\(x\)
+    ->    debugger\.breakpoint\(stdin=_stdin, stdout=_stdout, backend="cli"\)
+          return y
+    .*
+    \(jdb\) """))
 
 prev_xla_flags = None
 
 def setUpModule():
   global prev_xla_flags
-  # This will control the CPU devices. On TPU we always have 2 devices
-  prev_xla_flags = jtu.set_host_platform_device_count(2)
+  # This will control the CPU devices. On TPU we always have 2 devices. The
+  # flag is only read when the backends are created, so once they exist
+  # rewriting it (and dropping the cached backends) buys nothing.
+  if not xla_bridge.backends_are_initialized():
+    prev_xla_flags = jtu.set_host_platform_device_count(2)
 
 # Reset to previous configuration in case other test modules will be run.
 def tearDownModule():
-  prev_xla_flags()
+  if prev_xla_flags is not None:
+    prev_xla_flags()
 
 foo = 2
 
 class CliDebuggerTest(jtu.JaxTestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Not created at import: that would bring up the backends before
+    # setUpModule gets to set the host device count.
+    cls.x_scalar = jnp.array(2., jnp.float32)
+    cls.x_vec = jnp.arange(2., dtype=jnp.float32)
+
   def setUp(self):
     super().setUp()
     if not jtu.test_device_matches(["cpu", "gpu", "tpu"]):
       self.skipTest(f"Host callback not supported on {jtu.device_under_test()}")
 
+  def tearDown(self):
+    # Don't let callbacks from one test run into the next. Tests that check
+    # output of a jitted breakpoint still need their own barrier before the
+    # assertion; tests that call the breakpoint eagerly run the callback
+    # synchronously and rely on this one alone.
+    jax.effects_barrier()
+    super().tearDown()
+
   def test_debugger_eof(self):
     stdin, stdout = make_fake_stdin_stdout([])
 
@@ -70,7 +156,6 @@ class CliDebuggerTest(jtu.JaxTestCase):
       return y
     with self.assertRaises(SystemExit):
       f(2.)
-      jax.effects_barrier()
 
   def test_debugger_can_continue(self):
     stdin, stdout = make_fake_stdin_stdout(["c"])
@@ -80,7 +165,6 @@ class CliDebuggerTest(jtu.JaxTestCase):
       debugger.breakpoint(stdin=stdin, stdout=stdout, backend="cli")
       return y
     f(2.)
-    jax.effects_barrier()
     expected = _format_multiline(r"""
     Entering jdb:
     (jdb) """)
@@ -97,23 +181,16 @@ class CliDebuggerTest(jtu.JaxTestCase):
     Entering jdb:
     (jdb) Array(2., dtype=float32)
     (jdb) """)
-    f(jnp.array(2., jnp.float32))
-    jax.effects_barrier()
+    f(self.x_scalar)
     self.assertEqual(stdout.getvalue(), expected)
 
   def test_debugger_can_print_value_in_jit(self):
-    stdin, stdout = make_fake_stdin_stdout(["p x", "c"])
-
-    @jax.jit
-    def f(x):
-      y = jnp.sin(x)
-      debugger.breakpoint(stdin=stdin, stdout=stdout, backend="cli")
-      return y
+    _, stdout = install_fake_stdin_stdout(["p x", "c"])
     expected = _format_multiline(r"""
     Entering jdb:
     (jdb) array(2., dtype=float32)
     (jdb) """)
-    f(jnp.array(2., jnp.float32))
+    _sin_with_breakpoint(self.x_scalar)
     jax.effects_barrier()
     self.assertEqual(stdout.getvalue(), expected)
 
@@ -129,45 +206,20 @@ class CliDebuggerTest(jtu.JaxTestCase):
     Entering jdb:
     (jdb) (array(2., dtype=float32), array(3., dtype=float32))
     (jdb) """)
-    f(jnp.array(2., jnp.float32))
+    f(self.x_scalar)
     jax.effects_barrier()
     self.assertEqual(stdout.getvalue(), expected)
 
-  def test_debugger_can_print_context(self):
-    stdin, stdout = make_fake_stdin_stdout(["l", "c"])
-
-    @jax.jit
-    def f(x):
-      y = jnp.sin(x)
-      debugger.breakpoint(stdin=stdin, stdout=stdout, backend="cli")
-      return y
-    f(2.)
-    jax.effects_barrier()
-    expected = _format_multiline(r"""
-    Entering jdb:
-    \(jdb\) > .*debugger_test\.py\([0-9]+\)
-            @jax\.jit
-            def f\(x\):
-              y = jnp\.sin\(x\)
-    ->        debugger\.breakpoint\(stdin=stdin, stdout=stdout, backend="cli"\)
-              return y
-    .*
-    \(jdb\) """)
-    self.assertRegex(stdout.getvalue(), expected)
-
-  def test_debugger_can_print_backtrace(self):
-    stdin, stdout = make_fake_stdin_stdout(["bt", "c"])
-
-    @jax.jit
-    def f(x):
-      y = jnp.sin(x)
-      debugger.breakpoint(stdin=stdin, stdout=stdout, backend="cli")
-      return y
-    expected = _format_multiline(r"""
+  @parameterized.named_parameters(
+      ("_context", ["l", "c"], _SIN_WITH_BREAKPOINT_CONTEXT_RE),
+      ("_backtrace", ["bt", "c"], _format_multiline(r"""
     Entering jdb:.*
     \(jdb\) Traceback:.*
-    """)
-    f(2.)
+    """)),
+  )
+  def test_debugger_can_print(self, commands, expected):
+    _, stdout = install_fake_stdin_stdout(commands)
+    _sin_with_breakpoint(self.x_scalar)
     jax.effects_barrier()
     self.assertRegex(stdout.getvalue(), expected)
 
@@ -205,7 +257,7 @@ class CliDebuggerTest(jtu.JaxTestCase):
               return y
     .*
     \(jdb\) """)
-    g(jnp.array(2., jnp.float32))
+    g(self.x_scalar)
     jax.effects_barrier()
     self.assertRegex(stdout.getvalue(), expected)
 
@@ -230,7 +282,7 @@ class CliDebuggerTest(jtu.JaxTestCase):
     (jdb) Entering jdb:
     (jdb) array(6., dtype=float32)
     (jdb) """)
-    g(jnp.array(2., jnp.float32))
+    g(self.x_scalar)
     jax.effects_barrier()
     self.assertEqual(stdout.getvalue(), expected)
 
@@ -259,7 +311,7 @@ class CliDebuggerTest(jtu.JaxTestCase):
     (jdb) Entering jdb:
     (jdb) array(2., dtype=float32)
     (jdb) """)
-    g(jnp.arange(2., dtype=jnp.float32))
+    g(self.x_vec)
     jax.effects_barrier()
     self.assertEqual(stdout.getvalue(), expected)
 
@@ -267,24 +319,14 @@ class CliDebuggerTest(jtu.JaxTestCase):
     if jax.local_device_count() < 2:
       raise unittest.SkipTest("Test requires >= 2 devices.")
 
-    stdin, stdout = make_fake_stdin_stdout(["p y", "c", "p y", "c"])
-
-    def f(x):
-      y = jnp.sin(x)
-      debugger.breakpoint(stdin=stdin, stdout=stdout, backend="cli")
-      return y
-
-    @jax.pmap
-    def g(x):
-      y = f(x)
-      return jnp.exp(y)
+    _, stdout = install_fake_stdin_stdout(["p y", "c", "p y", "c"])
     expected = _format_multiline(r"""
     Entering jdb:
     \(jdb\) array\(.*, dtype=float32\)
     \(jdb\) Entering jdb:
     \(jdb\) array\(.*, dtype=float32\)
     \(jdb\) """)
-    g(jnp.arange(2., dtype=jnp.float32))
+    _pmap_sin_exp_with_breakpoint(self.x_vec)
     jax.effects_barrier()
     self.assertRegex(stdout.getvalue(), expected)
 
@@ -307,12 +349,12 @@ class CliDebuggerTest(jtu.JaxTestCase):
         in_shardings=jax.sharding.PartitionSpec("dev"),
         out_shardings=jax.sharding.PartitionSpec("dev"),
     )
+    arr = (1 + np.arange(8)).astype(np.int32)
+    expected = _format_multiline(r"""
+    Entering jdb:
+    \(jdb\) {}
+    \(jdb\) """.format(re.escape(repr(arr))))
     with jax.sharding.Mesh(np.array(jax.devices()), ["dev"]):
-      arr = (1 + np.arange(8)).astype(np.int32)
-      expected = _format_multiline(r"""
-      Entering jdb:
-      \(jdb\) {}
-      \(jdb\) """.format(re.escape(repr(arr))))
       g(jnp.arange(8, dtype=jnp.int32))
       jax.effects_barrier()
       self.assertRegex(stdout.getvalue(), expected)
@@ -334,7 +376,6 @@ class CliDebuggerTest(jtu.JaxTestCase):
     \(jdb\) 'inner'
     \(jdb\) """)
     f(2.)
-    jax.effects_barrier()
     self.assertRegex(stdout.getvalue(), expected)
 
   def test_debugger_accesses_globals(self):